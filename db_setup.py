@@ -1,6 +1,8 @@
 import os
+import numpy as np
 import pandas as pd
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 import download_params
@@ -18,34 +20,54 @@ def get_all_csvs(path: str, path_excluded: str = None) -> list:
     """
     # find all csv files in a given directory, subdirectories can be excluded (path_axclude)
     csv_files = []
-    for root, dirs, files in os.walk(path):
-        if not root == path_excluded:
-            for file in files:
-                if file.split(".")[-1] == "csv":
-                    csv_files.append(os.path.join(root, file))
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        # skip the excluded path and, like os.walk, directories that don't exist
+        if directory == path_excluded or not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".csv"):
+                    csv_files.append(entry.path)
 
     return csv_files
 
 
-def get_col_types_for_db(df: pd.DataFrame, primary_key: str = None) -> list:
-    """Gets the column types for a sqlite database from dtypes of a given dataframe.
+def quote_identifier(name: str) -> str:
+    """Quotes a table or column name for use in an SQL command.
 
     Args:
-        df (pd.DataFrame): Database to derive data types from.
+        name (str): Name of the table or column.
+
+    Returns:
+        str: Name in double quotes, so spaces, hyphens and SQL keywords are allowed.
+    """
+    # double quotes inside the name are escaped by doubling them
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def get_col_types_for_db(dtypes: pd.Series, primary_key: str = None) -> list:
+    """Gets the column types for a sqlite database from the dtypes of a dataframe.
+
+    Args:
+        dtypes (pd.Series): Dtypes of the columns to derive data types from, e.g. df.dtypes[columns].
         primary_key (str, optional): Primary key for the database table. Defaults to None.
 
     Returns:
-        list: Database data types for all columns of the given dataframe.
+        list: Database data types for all columns of the given dtypes.
     """
-    # Get dtypes of all columns in the given dataframe and translate them to database data types
+    # translate the dtypes of all columns to database data types
     col_types = []
-    for col in df.columns:
+    for col, dtype in dtypes.items():
         data_type = ""
-        if df[col].dtype == int:
+        if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
             data_type = "INTEGER"
-        elif df[col].dtype == float:
+        elif pd.api.types.is_float_dtype(dtype):
             data_type = "REAL"
-        elif df[col].dtype == object:
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
             data_type = "TEXT"
         # if the given column was specified as primary key, add the corresponding string
         if col == primary_key:
@@ -65,13 +87,41 @@ def make_table_command(table_name: str, columns: list, col_types: list) -> str:
     Returns:
         str: SQL command to create the table.
     """
-    # make the beginning of the command using the table name
-    command = f"CREATE TABLE {table_name} ("
-    # add for every column  name and data type 
-    for i, col in enumerate(columns):
-        command = command + f"{col} {col_types[i]}, "
-    # return string without the last comma and whitespace and close the parenthesis
-    return command[:-2] + ")"
+    # join name and data type of every column and put them into the parenthesis after the table name
+    column_definitions = ", ".join(
+        f"{quote_identifier(col)} {col_type}" for col, col_type in zip(columns, col_types)
+    )
+    return f"CREATE TABLE {quote_identifier(table_name)} ({column_definitions})"
+
+
+def read_data_file(csv_file: str) -> pd.DataFrame:
+    """Reads a data file into a dataframe.
+
+    Args:
+        csv_file (str): Path to the csv file to read.
+
+    Returns:
+        pd.DataFrame: Data of the file without columns containing 'Unnamed'.
+    """
+    # skip columns containing 'Unnamed' while parsing
+    return pd.read_csv(csv_file, usecols=lambda col: "Unnamed" not in col, low_memory=False)
+
+
+def make_insert_command(table_name: str, columns: list, ignore_duplicates: bool = False) -> str:
+    """Creates a parameterized SQL command to insert rows into a table with the given columns.
+
+    Args:
+        table_name (str): Name of the table to insert rows into.
+        columns (list): Names of the columns to insert values for.
+        ignore_duplicates (bool, optional): Whether or not to skip rows whose primary key already exists. Defaults to False.
+
+    Returns:
+        str: SQL command with one placeholder per column.
+    """
+    placeholders = ", ".join(["?"] * len(columns))
+    insert = "INSERT OR IGNORE" if ignore_duplicates else "INSERT"
+    column_names = ", ".join(quote_identifier(col) for col in columns)
+    return f"{insert} INTO {quote_identifier(table_name)} ({column_names}) VALUES ({placeholders})"
 
 
 def make_database(database_path: str, df: pd.DataFrame) -> dict:
@@ -133,14 +183,9 @@ def make_database(database_path: str, df: pd.DataFrame) -> dict:
         "DestWac",
     ]
     # from the definitions before, get columns for the flight table
-    cols_flight = [
-        col for col in df.columns \
-        if (col not in cols_time \
-        and col not in cols_airline \
-        and col not in cols_airport_origin \
-        and col not in cols_airport_dest) \
-        or col in cols_id
-    ]
+    cols_excluded = set(cols_time) | set(cols_airline) | set(cols_airport_origin) | set(cols_airport_dest)
+    cols_id_set = set(cols_id)
+    cols_flight = [col for col in df.columns if col not in cols_excluded or col in cols_id_set]
     # derive columns for airport table from the destination airport column list
     cols_airport = [
         col[4:] if col != "Dest" else "Airport" for col in cols_airport_dest
@@ -150,22 +195,22 @@ def make_database(database_path: str, df: pd.DataFrame) -> dict:
     make_table_commands = []
     make_table_commands.append(
         make_table_command(
-            "time_period", cols_time, get_col_types_for_db(df[cols_time], primary_key="FlightDate",)
+            "time_period", cols_time, get_col_types_for_db(df.dtypes[cols_time], primary_key="FlightDate",)
         )
     )
     make_table_commands.append(
         make_table_command(
-            "airports", cols_airport, get_col_types_for_db(df[cols_airport_dest], primary_key="DestAirportID")
+            "airports", cols_airport, get_col_types_for_db(df.dtypes[cols_airport_dest], primary_key="DestAirportID")
         )
     )
     make_table_commands.append(
         make_table_command(
-            "airlines", cols_airline, get_col_types_for_db(df[cols_airline], primary_key="Reporting_Airline",)
+            "airlines", cols_airline, get_col_types_for_db(df.dtypes[cols_airline], primary_key="Reporting_Airline",)
         )
     )
     make_table_commands.append(
         make_table_command(
-            "flights", cols_flight, get_col_types_for_db(df[cols_flight])
+            "flights", cols_flight, get_col_types_for_db(df.dtypes[cols_flight])
         )
     )
 
@@ -188,35 +233,63 @@ def make_database(database_path: str, df: pd.DataFrame) -> dict:
     return {"time_period": cols_time, "airports": cols_airport, "airlines": cols_airline, "flights": cols_flight}
 
 
-def get_uniques(df: pd.DataFrame, column_uniques: str) -> pd.DataFrame:
-    """Filters a dataframe by unique values of one column.
+def get_first_indices(values: np.ndarray) -> np.ndarray:
+    """Gets the positions of the first occurrence of every unique value.
 
     Args:
-        df (pd.DataFrame): Dataframe to filter.
+        values (np.ndarray): Values to look for unique values in.
+
+    Returns:
+        np.ndarray: Positions of the first occurrences in order of appearance.
+    """
+    # hash based, so it doesn't need to sort and handles missing values in object columns
+    return pd.Series(values).drop_duplicates().index.to_numpy()
+
+
+def get_unique_rows(columns: dict, column_uniques: str) -> list:
+    """Gets the rows of the first occurrence of every value of one column.
+
+    Args:
+        columns (dict): Column names and arrays of equal length holding their values. Rows are built in this column order.
         column_uniques (str): Column to look for unique values in.
 
     Returns:
-        pd.DataFrame: Dataframe with unique values of column_uniques apearing only once.
+        list: Tuples with the values of all columns for every unique value of column_uniques.
     """
-    # add the first row for each unique value in column_uniques to a dataframe
-    df_uniques = pd.DataFrame()
-    for val in df[column_uniques].unique():
-        df_uniques = pd.concat([df_uniques, df[df[column_uniques]==val].iloc[:1,:]])
-    return df_uniques
+    # gather the values of all columns for the first occurrence of every unique value
+    first_indices = get_first_indices(columns[column_uniques])
+    return list(zip(*(values[first_indices].tolist() for values in columns.values())))
+
+
+def insert_dataframe(df: pd.DataFrame, table_name: str, db_connection: sqlite3.Connection):
+    """Inserts all rows of a dataframe into an existing database table without committing.
+
+    Args:
+        df (pd.DataFrame): Dataframe to insert. Column names must match the column names of the table.
+        table_name (str): Name of the table to insert the data into.
+        db_connection (sqlite3.Connection): Connection to the database. Committing is left to the caller.
+    """
+    # pandas' to_sql commits after every call, so insert the rows directly to keep them in the caller's transaction
+    db_connection.executemany(
+        make_insert_command(table_name, df.columns), df.itertuples(index=False, name=None)
+    )
 
 
 def transfer_look_up_table_to_db(path_file: str, db_connection: sqlite3.Connection):
-    """Transfers data of look up tables to a database.
+    """Transfers data of look up tables to a database without committing.
 
     Args:
         path_file (str): Path to the csv file containing a look up table.
-        db_connection (sqlite3.Connection): Connection to a database to transfer data to.
+        db_connection (sqlite3.Connection): Connection to a database to transfer data to. Committing is left to the caller.
     """
     # use file name without extension as table name
     table_name = path_file.split("/")[-1].split(".")[0]
 
-    # write data to database
-    pd.read_csv(path_file).to_sql(table_name, db_connection, if_exists="replace", index=False)
+    # replace the table with the data of the file
+    df = pd.read_csv(path_file)
+    db_connection.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)}")
+    db_connection.execute(make_table_command(table_name, df.columns, get_col_types_for_db(df.dtypes)))
+    insert_dataframe(df, table_name, db_connection)
 
 
 if __name__ == "__main__":
@@ -228,68 +301,105 @@ if __name__ == "__main__":
     # get csv files from the download folder excluding look up tables
     data_files = get_all_csvs(download_params.DOWNLOAD_PATH, download_params.DOWNLOAD_PATH_LOOKUP)
 
-    # make empty dataframes to append data from the csv files afterwards
-    df_time_periods = pd.DataFrame()
-    df_airports = pd.DataFrame()
-    df_airlines = pd.DataFrame()
-
     print("transfer data to database...")
 
     # visualize file processing with a progress bar
-    with tqdm(total=len(data_files)) as pbar:
-        
-        # process the data files found before
-        for i, csv_file in enumerate(data_files):
+    # and parse the next file in a background thread while the current one is written to the database
+    with tqdm(total=len(data_files)) as pbar, ThreadPoolExecutor(max_workers=1) as executor:
+        next_df = executor.submit(read_data_file, data_files[0])
 
-            # read one file into a dataframe
-            df = pd.read_csv(csv_file, low_memory=False)
+        # process the data files found before
+        for i in range(len(data_files)):
 
-            # drop columns containing 'Unnamed'
-            for col in df.columns:
-                if "Unnamed" in col:
-                    df.drop(col, axis=1, inplace=True)
+            # get the dataframe of the current file and start reading the next one
+            df = next_df.result()
+            if i + 1 < len(data_files):
+                next_df = executor.submit(read_data_file, data_files[i + 1])
             
             # in the first loop make the databse and connect to it
             if not i:
+                new_database = not os.path.exists(db_path)
                 db_tables = make_database(db_path, df)
-                conn = sqlite3.connect(db_path)
+                # manage transactions manually to write all data files in a single transaction
+                conn = sqlite3.connect(db_path, isolation_level=None)
+                if new_database:
+                    # a new database can simply be rebuilt if loading fails, so skip journaling and syncing
+                    conn.execute("PRAGMA journal_mode=OFF")
+                    conn.execute("PRAGMA synchronous=OFF")
+                else:
+                    # data gets appended to an existing database, keep a journal to protect it if loading fails
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                # keep the single writer's pages in memory
+                conn.execute("PRAGMA temp_store=MEMORY")
+                conn.execute("PRAGMA cache_size=-262144")
+                conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+                conn.execute("BEGIN")
+                # build the insert command for flights once, so sqlite reuses the prepared statement for all files
+                insert_flights_command = make_insert_command("flights", db_tables["flights"])
+                # rows of time periods, airports and airlines whose key is in the database already get skipped by sqlite
+                insert_time_period_command = make_insert_command(
+                    "time_period", db_tables["time_period"], ignore_duplicates=True
+                )
+                insert_airports_command = make_insert_command("airports", db_tables["airports"], ignore_duplicates=True)
+                insert_airlines_command = make_insert_command("airlines", db_tables["airlines"], ignore_duplicates=True)
+                # map column names of the database airport table to column names of destination and origin airports
+                airport_source_columns = {
+                    col: (f"Dest{col}", f"Origin{col}") if col != "Airport" else ("Dest", "Origin")
+                    for col in db_tables["airports"]
+                }
+
+            # extract the values of every column once, all tables are built from these arrays
+            # without making intermediate dataframes
+            columns = {col: df[col].to_numpy() for col in df.columns}
 
             # process flights
-            # append data of flights to database
-            df[db_tables["flights"]].to_sql("flights", conn, if_exists="append", index=False)
-            
+            # append data of flights to database, converting values to python types row by row
+            # (sqlite can't bind numpy types) instead of materializing every column as a list
+            conn.executemany(
+                insert_flights_command,
+                zip(*(map(columns[col].item, range(len(df))) for col in db_tables["flights"])),
+            )
+
             # process airports
-            # filter for data of destination and origin airports
-            dest_airports = df[[f"Dest{col}" if col != "Airport" else "Dest" for col in db_tables["airports"]]]
-            origin_airports = df[[f"Origin{col}" if col != "Airport" else "Origin" for col in db_tables["airports"]]]
-            # set their column names equal to the column names of the database airport table to simplify appending
-            dest_airports.columns = origin_airports.columns = db_tables["airports"]
-            # add origin and destination airports to the airports dataframe and only keep unique values
-            df_airports = get_uniques(pd.concat([df_airports, dest_airports, origin_airports]), "AirportID")
+            # find the first occurrence of every airport among destination and origin airports using their ids only
+            dest_id_col, origin_id_col = airport_source_columns["AirportID"]
+            first_indices = get_first_indices(np.concatenate([columns[dest_id_col], columns[origin_id_col]]))
+            dest_indices = first_indices[first_indices < len(df)]
+            origin_indices = first_indices[first_indices >= len(df)] - len(df)
+            # stack values of these destination and origin airports under the column names of the database airport table
+            airports = {
+                col: np.concatenate([columns[dest_col][dest_indices], columns[origin_col][origin_indices]])
+                for col, (dest_col, origin_col) in airport_source_columns.items()
+            }
+            # add unique origin and destination airports of this file to the database
+            conn.executemany(insert_airports_command, zip(*(values.tolist() for values in airports.values())))
 
             # process airlines
-            # add only uniques of airlines to the airline dataframe to keep it small 
-            airlines = get_uniques(df[db_tables["airlines"]], "Reporting_Airline")
-            df_airlines = pd.concat([df_airlines, airlines])
+            # add unique airlines of this file to the database
+            airlines = {col: columns[col] for col in db_tables["airlines"]}
+            conn.executemany(insert_airlines_command, get_unique_rows(airlines, "Reporting_Airline"))
 
             # process time periods
-            # add only uniques of time periods to the time period dataframe to keep it small 
-            time_periods = get_uniques(df[db_tables["time_period"]], "FlightDate")
-            df_time_periods = pd.concat([df_time_periods, time_periods])
+            # add unique time periods of this file to the database
+            time_periods = {col: columns[col] for col in db_tables["time_period"]}
+            conn.executemany(insert_time_period_command, get_unique_rows(time_periods, "FlightDate"))
+
+            # release all data of this file, so only the file parsed in the background and the next one are held in memory
+            del df, columns, airports, airlines, time_periods
             
             # update progress bar
             pbar.update(1)
 
-    # add the time periods dataframe to the database
-    df_time_periods.to_sql("time_period", conn, if_exists="append", index=False)
-    # add uniques of airport and airlines dataframe to the database
-    get_uniques(df_airports, "AirportID").to_sql("airports", conn, if_exists="append", index=False)
-    get_uniques(df_airlines, "Reporting_Airline").to_sql("airlines", conn, if_exists="append", index=False)
+    # commit flights, time periods, airports and airlines at once
+    conn.execute("COMMIT")
 
     print("transfer look up tables to database...")
-    # add look up tables to the database
+    # add look up tables to the database in a single transaction
+    conn.execute("BEGIN")
     for look_up_table in tqdm(get_all_csvs(download_params.DOWNLOAD_PATH_LOOKUP)):
         transfer_look_up_table_to_db(look_up_table, conn)
+    conn.execute("COMMIT")
 
     # close database connection
     conn.close()
@@ -1,6 +1,9 @@
 import os
 import requests
+import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 import download_params
 from bs4 import BeautifulSoup as bs
@@ -27,36 +30,64 @@ def get_download_params() -> tuple:
     )
 
 
-def download_file(url_dl: str, path: str, file_name: str = None):
+def make_session(pool_size: int = 16) -> requests.Session:
+    """Makes a session that reuses connections and can be shared between threads.
+
+    Args:
+        pool_size (int, optional): Number of connections to keep open per host. Defaults to 16.
+
+    Returns:
+        requests.Session: Session with a connection pool of the given size.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def download_file(url_dl: str, path: str, file_name: str = None, session: requests.Session = None):
     """Downloads a file and writes it to disk.
 
     Args:
         url_dl (str): Download URL of the file. 
         path (str): Path to save the file in.
         file_name (str): Name of the file, if None, file name is read from header of response. Defaults to None.
+        session (requests.Session, optional): Session to send the request with, if None, a new connection is used. Defaults to None.
     """
     
-    # if path doesn't exist, make it
-    if not os.path.exists(path):
-        os.mkdir(path)
-
-    # request download url
-    response = requests.get(url_dl, timeout=50, verify=False)
-
-    # if the file name was not specified, get it from download server
-    if not file_name:
-        try:
-            file_name = response.headers["Content-Disposition"][
-                response.headers["Content-Disposition"].find("filename=") + len("filename="):
-            ]
-        except Exception as e:
-            print(f"file name could not be read from server for {url_dl}")
-            print("download gets skipped")
-
-    # write file to disk
-    if file_name:
-        with open(os.path.join(path, file_name), 'wb') as f:
-            f.write(response.content)
+    # if path doesn't exist, make it (several threads may try this at the same time)
+    os.makedirs(path, exist_ok=True)
+
+    # request download url, stream the body instead of buffering it and don't let the server compress zip files again
+    with (session or requests).get(
+        url_dl, stream=True, timeout=50, verify=False, headers={"Accept-Encoding": "identity"}
+    ) as response:
+        response.raise_for_status()
+
+        # if the file name was not specified, get it from download server
+        if not file_name:
+            try:
+                file_name = response.headers["Content-Disposition"][
+                    response.headers["Content-Disposition"].find("filename=") + len("filename="):
+                ]
+            except Exception as e:
+                print(f"file name could not be read from server for {url_dl}")
+                print("download gets skipped")
+
+        # write file to disk in chunks of 1 MiB, write to a temporary file and only rename it when complete,
+        # so an interrupted download isn't taken for a complete file
+        if file_name:
+            path_file = os.path.join(path, file_name)
+            try:
+                with open(path_file + ".part", 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+                os.replace(path_file + ".part", path_file)
+            finally:
+                # remove an incomplete file, e.g. after an error or an interruption
+                if os.path.exists(path_file + ".part"):
+                    os.remove(path_file + ".part")
 
 
 def unzip_file(path_zip: str, file_to_extract: str, path_target: str = None, delete_zip: bool = False):
@@ -77,21 +108,66 @@ def unzip_file(path_zip: str, file_to_extract: str, path_target: str = None, del
         path_target = "/".join(path_zip.split("/")[:-1])
     
     # if the file to extract doesn't exist, extract from zip file
-    if not os.path.exists(os.path.join(path_target, file_to_extract)):
+    path_extracted = os.path.join(path_target, file_to_extract)
+    if not os.path.exists(path_extracted):
         try:
-            with zipfile.ZipFile(path_zip) as z:
-                with open(os.path.join(path_target, file_to_extract), 'wb') as f:
-                    f.write(z.read(file_to_extract))
+            # stream the file out of the archive in chunks of 1 MiB instead of reading it into memory at once,
+            # write to a temporary file and only rename it when complete, so no truncated file is left behind
+            with zipfile.ZipFile(path_zip) as z, z.open(file_to_extract) as src, \
+                    open(path_extracted + ".part", 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(path_extracted + ".part", path_extracted)
         except Exception as e:
             print(f"Error when unzipping {path_zip}: {e}")
+            # keep the zip file if unzipping failed
+            return
+        finally:
+            # remove an incomplete file, e.g. after an error or an interruption
+            if os.path.exists(path_extracted + ".part"):
+                os.remove(path_extracted + ".part")
     
     # delete zip file if necessary
     if delete_zip:
         os.remove(path_zip)
 
 
-def download_and_unzip_years(url_root: str, path: str, years: int or list, zip_prefix: str, csv_prefix: str):
-    """Downloads and unzips a file.
+def download_and_unzip_month(
+    url_root: str, path: str, year: int, month: int, zip_prefix: str, csv_prefix: str, session: requests.Session = None
+):
+    """Downloads and unzips the file of a single month.
+
+    Args:
+        url_root (str): Root URL to the file to download.
+        path (str): Path to save the downloaded file at.
+        year (int): Year to download data for.
+        month (int): Month to download data for.
+        zip_prefix (str): Prefix of the zip files.
+        csv_prefix (str): Prefix of the csv files.
+        session (requests.Session, optional): Session to send the request with. Defaults to None.
+    """
+    # make url, names and path for downloading and naming files
+    url_download = url_root + zip_prefix + f"{year}_{month}.zip"
+    name_zip = zip_prefix + f"{year}_{month}.zip"
+    name_csv = csv_prefix + f"{year}_{month}.csv"
+    path_zip = os.path.join(path, name_zip)
+
+    # download and unzip the file if csv, respectively zip file doesn't exist
+    if not os.path.isfile(os.path.join(path, name_csv)):
+        if not os.path.isfile(path_zip):
+            try:
+                download_file(url_download, path, name_zip, session=session)
+            except requests.HTTPError as e:
+                # e.g. months that are not published yet, skip them so all other files still get processed
+                print(f"Error when downloading {url_download}: {e}")
+                print("month gets skipped")
+                return
+        unzip_file(path_zip, name_csv, path_target=None, delete_zip=True)
+
+
+def download_and_unzip_years(
+    url_root: str, path: str, years: int or list, zip_prefix: str, csv_prefix: str, max_workers: int = 12
+):
+    """Downloads and unzips files of whole years.
 
     Args:
         url_root (str): Root URL to the file to download.
@@ -99,6 +175,7 @@ def download_and_unzip_years(url_root: str, path: str, years: int or list, zip_p
         years (int or list): Year or list of years to download data for.
         zip_prefix (str): Prefix of the zip files.
         csv_prefix (str): Prefix of the csv files.
+        max_workers (int, optional): Number of months to download and unzip at the same time. Defaults to 12.
     """
     # if years was passed as integer, make it a list
     if type(years) == int:
@@ -106,23 +183,19 @@ def download_and_unzip_years(url_root: str, path: str, years: int or list, zip_p
 
     print("Processing data files...")
 
-    # use a progress bar to visualize file processing
-    with tqdm(total=len(years) * 12) as pbar:
-        # download process files for all months in the specified years
-        for year in years:
-            for month in range(1, 13):
-                # make url, names and path for downloading and naming files
-                url_download = url_root + zip_prefix + f"{year}_{month}.zip"
-                name_zip = zip_prefix + f"{year}_{month}.zip"
-                name_csv = csv_prefix + f"{year}_{month}.csv"
-                path_zip = os.path.join(path, name_zip)
-
-                # download and unzip the file if csv, respectively zip file doesn't exist
-                if not os.path.isfile(os.path.join(path, name_csv)):
-                    if not os.path.isfile(path_zip):
-                        download_file(url_download, path, name_zip)
-                    unzip_file(path_zip, name_csv, path_target=None, delete_zip=True)
-                
+    # download and unzip all months in the specified years concurrently, sharing connections between threads
+    with make_session() as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_and_unzip_month, url_root, path, year, month, zip_prefix, csv_prefix, session)
+            for year in years
+            for month in range(1, 13)
+        ]
+
+        # use a progress bar to visualize file processing
+        with tqdm(total=len(futures)) as pbar:
+            for future in as_completed(futures):
+                # raise errors of the worker threads here
+                future.result()
                 # proceed progress bar
                 pbar.update(1)
 
@@ -143,28 +216,37 @@ def get_lookup_urls(url_root: str, download_root: str) -> list:
     download_urls = []
 
     # find all download links for look up tables and add it to the list
-    for i, link in enumerate(soup.findAll('a')):
-        try:
-            if soup.select('a')[i].attrs['title'] == "Download Lookup data":
-                download_urls.append(download_root + link.get('href'))
-        except KeyError:
-            continue
+    for link in soup.find_all('a', title="Download Lookup data"):
+        download_urls.append(download_root + link['href'])
     return download_urls
 
 
-def download_lookup_tables(url_root: str, download_root: str, path: str):
+def download_lookup_tables(url_root: str, download_root: str, path: str, max_workers: int = 20):
     """Downloads look up tables as csv files.
 
     Args:
         url_root (str): URL to website to search for look up table download links.
         download_root (str): Root URL for downloading for downloading look up tables.
         path (str): Path to save look up table csv files.
+        max_workers (int, optional): Number of look up tables to download at the same time. Defaults to 20.
     """
     print("Processing look up tables...")
 
-    # get download links for look up tables and download them
-    for url_dl in tqdm(get_lookup_urls(url_root, download_root)):
-        download_file(url_dl, path)
+    # get download links for look up tables and download them concurrently, sharing connections between threads
+    with make_session(pool_size=max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_file, url_dl, path, session=session)
+            for url_dl in get_lookup_urls(url_root, download_root)
+        ]
+
+        # use a progress bar to visualize file processing
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            # raise errors of the worker threads here, but only skip look up tables that couldn't be downloaded
+            try:
+                future.result()
+            except requests.HTTPError as e:
+                print(f"Error when downloading {e.request.url}: {e}")
+                print("download gets skipped")
 
 
 if __name__ == "__main__":